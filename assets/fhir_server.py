@@ -4,13 +4,21 @@ Basic FHIR Server using FastAPI
 Provides a foundation for building FHIR-compliant APIs
 """
 
-from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi import FastAPI, HTTPException, Depends, Request, Query
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from typing import Dict, Any, Optional, List
+from starlette.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response, StreamingResponse
+from typing import Dict, Optional, List, Set, Iterable
 import uvicorn
+import anyio
+import threading
+from contextlib import asynccontextmanager
+import bisect
+import itertools
 from datetime import datetime
 import json
+import orjson
 import os
 
 # FHIR imports
@@ -18,14 +26,19 @@ from fhir.resources.patient import Patient
 from fhir.resources.observation import Observation
 from fhir.resources.bundle import Bundle, BundleEntry
 from fhir.resources.capabilitystatement import CapabilityStatement
-from fhir.resources.operationoutcome import OperationOutcome, OperationOutcomeIssue
-from pydantic import ValidationError
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Write handlers are sync and run on the threadpool; widen it beyond the default 40
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 100
+    yield
 
 app = FastAPI(
     title="Example FHIR Server",
     description="Basic FHIR R4 compliant server",
     version="1.0.0",
-    docs_url="/docs"
+    docs_url="/docs",
+    lifespan=lifespan
 )
 
 # CORS middleware
@@ -33,39 +46,164 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+    allow_headers=[
+        "content-type", "accept", "authorization", "prefer", "x-requested-with",
+        "if-match", "if-none-match", "if-none-exist", "if-modified-since"
+    ],
+    max_age=86400,
 )
 
+# Compress Bundles and other large JSON bodies; level 4 keeps CPU cost low
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=4)
+
 # In-memory storage (use a real database in production)
 patients_db: Dict[str, Dict] = {}
 observations_db: Dict[str, Dict] = {}
+# Serialized JSON of each stored resource, written once per write and served as-is
+patients_bytes: Dict[str, bytes] = {}
+observations_bytes: Dict[str, bytes] = {}
+
+# Guards the stores and indices: writes run on the threadpool, searches iterate
+_db_lock = threading.Lock()
+
+# Patient search indices: lowercased value -> set of patient IDs
+_idx_family: Dict[str, Set[str]] = {}
+_idx_given: Dict[str, Set[str]] = {}
+_idx_gender: Dict[str, Set[str]] = {}
+_idx_birthdate: Dict[str, Set[str]] = {}
+# Lowercased, UTF-8 encoded "family given..." per HumanName, one per line, for `name`
+# search; bytes containment runs as a C-level substring search
+_name_haystack: Dict[str, bytes] = {}
+
+# Observation search indices: code tokens are lowercased "code" and "system|code"
+_idx_obs_code: Dict[str, Set[str]] = {}
+_idx_obs_subject: Dict[str, Set[str]] = {}
+# Parallel arrays sorted by effectiveDateTime for date prefix range lookups; bisect
+# compares plain strings and the matching IDs come out as one contiguous slice
+_obs_dates: List[str] = []
+_obs_date_ids: List[str] = []
 
 # Utility functions
 def create_operation_outcome(severity: str, code: str, details: str) -> Dict:
     """Create FHIR OperationOutcome for error responses"""
-    issue = OperationOutcomeIssue(
-        severity=severity,
-        code=code,
-        details={"text": details}
-    )
-    outcome = OperationOutcome(issue=[issue])
-    return outcome.dict(exclude_none=True)
+    # Built as a plain dict: the shape is fixed, so model validation buys nothing here
+    return {
+        "resourceType": "OperationOutcome",
+        "issue": [{
+            "severity": severity,
+            "code": code,
+            "details": {"text": details}
+        }]
+    }
 
 def generate_id() -> str:
     """Generate a simple ID for resources"""
-    from uuid import uuid4
-    return str(uuid4())
-
-def validate_fhir_resource(resource_data: Dict, resource_class) -> Any:
-    """Validate FHIR resource using Pydantic models"""
-    try:
-        return resource_class(**resource_data)
-    except ValidationError as e:
-        raise HTTPException(
-            status_code=400,
-            detail=create_operation_outcome("error", "invalid", str(e))
-        )
+    # 96 random bits as 24 hex chars; hex stays within the FHIR id charset
+    return os.urandom(12).hex()
+
+# FastAPI validates request bodies against the FHIR models; report failures as OperationOutcome
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    # Only location and message; str(exc) also carries the endpoint's source location
+    details = "; ".join(
+        f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in exc.errors()
+    )
+    return Response(
+        status_code=400,
+        content=orjson.dumps(create_operation_outcome("error", "invalid", details)),
+        media_type="application/fhir+json"
+    )
+
+def _patient_index_entries(patient_data: Dict):
+    """Yield (index, key) pairs a patient is stored under"""
+    for n in patient_data.get("name", []):
+        if n.get("family"):
+            yield _idx_family, n["family"].lower()
+        for g in n.get("given", []):
+            yield _idx_given, g.lower()
+    if patient_data.get("gender"):
+        yield _idx_gender, patient_data["gender"].lower()
+    if patient_data.get("birthDate"):
+        yield _idx_birthdate, patient_data["birthDate"]
+
+def index_patient(patient_id: str, patient_data: Dict) -> None:
+    """Add a patient to the search indices"""
+    for index, key in _patient_index_entries(patient_data):
+        index.setdefault(key, set()).add(patient_id)
+    _name_haystack[patient_id] = "\n".join(
+        (n.get("family", "") + " " + " ".join(n.get("given", []))).lower()
+        for n in patient_data.get("name", [])
+    ).encode()
+
+def unindex_patient(patient_id: str, patient_data: Dict) -> None:
+    """Remove a patient from the search indices"""
+    for index, key in _patient_index_entries(patient_data):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(patient_id)
+            if not ids:
+                del index[key]
+    _name_haystack.pop(patient_id, None)
+
+def match_index_substring(index: Dict[str, Set[str]], value: str) -> Set[str]:
+    """Collect IDs whose indexed key contains value (case-insensitive)"""
+    needle = value.lower()
+    return {pid for key, ids in index.items() if needle in key for pid in ids}
+
+def _observation_index_entries(obs_data: Dict):
+    """Yield (index, key) pairs an observation is stored under"""
+    for coding in obs_data.get("code", {}).get("coding", []):
+        if coding.get("code"):
+            token = coding["code"].lower()
+            yield _idx_obs_code, token
+            if coding.get("system"):
+                yield _idx_obs_code, coding["system"].lower() + "|" + token
+    if obs_data.get("subject", {}).get("reference"):
+        yield _idx_obs_subject, obs_data["subject"]["reference"]
+
+def index_observation(observation_id: str, obs_data: Dict) -> None:
+    """Add an observation to the search indices"""
+    for index, key in _observation_index_entries(obs_data):
+        index.setdefault(key, set()).add(observation_id)
+    if obs_data.get("effectiveDateTime"):
+        i = bisect.bisect_right(_obs_dates, obs_data["effectiveDateTime"])
+        _obs_dates.insert(i, obs_data["effectiveDateTime"])
+        _obs_date_ids.insert(i, observation_id)
+
+def unindex_observation(observation_id: str, obs_data: Dict) -> None:
+    """Remove an observation from the search indices"""
+    for index, key in _observation_index_entries(obs_data):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(observation_id)
+            if not ids:
+                del index[key]
+    if obs_data.get("effectiveDateTime"):
+        obs_date = obs_data["effectiveDateTime"]
+        lo = bisect.bisect_left(_obs_dates, obs_date)
+        hi = bisect.bisect_right(_obs_dates, obs_date, lo)
+        for i in range(lo, hi):
+            if _obs_date_ids[i] == observation_id:
+                del _obs_dates[i]
+                del _obs_date_ids[i]
+                break
+
+def match_date_prefix(date: str) -> Set[str]:
+    """Collect observation IDs whose effectiveDateTime starts with date"""
+    lo = bisect.bisect_left(_obs_dates, date)
+    hi = bisect.bisect_left(_obs_dates, date + "\uffff", lo)
+    return set(_obs_date_ids[lo:hi])
+
+def stream_searchset(total: int, resources: Iterable[bytes]) -> StreamingResponse:
+    """Stream a searchset Bundle from pre-serialized resources, one entry at a time"""
+    def generate():
+        yield b'{"resourceType":"Bundle","type":"searchset","total":%d,"entry":[' % total
+        for i, resource in enumerate(resources):
+            entry = b'{"resource":' + resource + b',"search":{"mode":"match"}}'
+            yield entry if i == 0 else b"," + entry
+        yield b"]}"
+    return StreamingResponse(generate(), media_type="application/fhir+json")
 
 # Dependency for FHIR content type
 async def validate_fhir_content_type(request: Request):
@@ -80,67 +218,68 @@ async def validate_fhir_content_type(request: Request):
                 )
             )
 
+# Capability statement is static, so build and serialize it once at startup
+_CAPABILITY_STATEMENT = {
+    "resourceType": "CapabilityStatement",
+    "status": "active",
+    "date": datetime.utcnow().isoformat() + "Z",
+    "publisher": "Example FHIR Server",
+    "kind": "instance",
+    "software": {
+        "name": "FastAPI FHIR Server",
+        "version": "1.0.0"
+    },
+    "fhirVersion": "4.0.1",
+    "format": ["application/fhir+json"],
+    "rest": [{
+        "mode": "server",
+        "resource": [
+            {
+                "type": "Patient",
+                "interaction": [
+                    {"code": "read"},
+                    {"code": "create"},
+                    {"code": "update"},
+                    {"code": "delete"},
+                    {"code": "search-type"}
+                ],
+                "searchParam": [
+                    {"name": "name", "type": "string"},
+                    {"name": "family", "type": "string"},
+                    {"name": "given", "type": "string"},
+                    {"name": "birthdate", "type": "date"},
+                    {"name": "gender", "type": "token"}
+                ]
+            },
+            {
+                "type": "Observation", 
+                "interaction": [
+                    {"code": "read"},
+                    {"code": "create"},
+                    {"code": "search-type"}
+                ],
+                "searchParam": [
+                    {"name": "subject", "type": "reference"},
+                    {"name": "patient", "type": "reference"},
+                    {"name": "code", "type": "token"},
+                    {"name": "date", "type": "date"}
+                ]
+            }
+        ]
+    }]
+}
+_CAPABILITY_JSON = orjson.dumps(_CAPABILITY_STATEMENT)
+
 # Metadata endpoint
-@app.get("/metadata", response_model=Dict)
+@app.get("/metadata")
 async def get_capability_statement():
     """Return server capability statement"""
-    capability = {
-        "resourceType": "CapabilityStatement",
-        "status": "active",
-        "date": datetime.utcnow().isoformat() + "Z",
-        "publisher": "Example FHIR Server",
-        "kind": "instance",
-        "software": {
-            "name": "FastAPI FHIR Server",
-            "version": "1.0.0"
-        },
-        "fhirVersion": "4.0.1",
-        "format": ["application/fhir+json"],
-        "rest": [{
-            "mode": "server",
-            "resource": [
-                {
-                    "type": "Patient",
-                    "interaction": [
-                        {"code": "read"},
-                        {"code": "create"},
-                        {"code": "update"},
-                        {"code": "delete"},
-                        {"code": "search-type"}
-                    ],
-                    "searchParam": [
-                        {"name": "name", "type": "string"},
-                        {"name": "family", "type": "string"},
-                        {"name": "given", "type": "string"},
-                        {"name": "birthdate", "type": "date"},
-                        {"name": "gender", "type": "token"}
-                    ]
-                },
-                {
-                    "type": "Observation", 
-                    "interaction": [
-                        {"code": "read"},
-                        {"code": "create"},
-                        {"code": "search-type"}
-                    ],
-                    "searchParam": [
-                        {"name": "subject", "type": "reference"},
-                        {"name": "patient", "type": "reference"},
-                        {"name": "code", "type": "token"},
-                        {"name": "date", "type": "date"}
-                    ]
-                }
-            ]
-        }]
-    }
-    return capability
+    return Response(content=_CAPABILITY_JSON, media_type="application/fhir+json")
 
 # Patient endpoints
 @app.post("/Patient", dependencies=[Depends(validate_fhir_content_type)])
-async def create_patient(patient_data: Dict[str, Any]):
+def create_patient(patient: Patient):
     """Create a new patient"""
-    patient = validate_fhir_resource(patient_data, Patient)
-    
     # Generate ID if not provided
     if not patient.id:
         patient.id = generate_id()
@@ -152,136 +291,129 @@ async def create_patient(patient_data: Dict[str, Any]):
     }
     
     # Store in database
-    patients_db[patient.id] = patient.dict(exclude_none=True)
+    payload = patient.model_dump(exclude_none=True, mode="json")
+    blob = orjson.dumps(payload)
+    with _db_lock:
+        if patient.id in patients_db:
+            unindex_patient(patient.id, patients_db[patient.id])
+        patients_db[patient.id] = payload
+        patients_bytes[patient.id] = blob
+        index_patient(patient.id, payload)
     
-    return JSONResponse(
+    return Response(
         status_code=201,
-        content=patients_db[patient.id],
+        content=blob,
+        media_type="application/fhir+json",
         headers={"Location": f"/Patient/{patient.id}"}
     )
 
 @app.get("/Patient/{patient_id}")
 async def get_patient(patient_id: str):
     """Read a patient by ID"""
-    if patient_id not in patients_db:
+    blob = patients_bytes.get(patient_id)
+    if blob is None:
         raise HTTPException(
             status_code=404,
             detail=create_operation_outcome("error", "not-found", f"Patient/{patient_id} not found")
         )
     
-    return patients_db[patient_id]
+    return Response(content=blob, media_type="application/fhir+json")
 
 @app.put("/Patient/{patient_id}", dependencies=[Depends(validate_fhir_content_type)])
-async def update_patient(patient_id: str, patient_data: Dict[str, Any]):
+def update_patient(patient_id: str, patient: Patient):
     """Update an existing patient"""
-    patient = validate_fhir_resource(patient_data, Patient)
-    
     # Ensure ID matches URL
     patient.id = patient_id
     
-    # Update metadata
-    existing = patients_db.get(patient_id, {})
-    current_version = int(existing.get("meta", {}).get("versionId", "0"))
-    
+    # Update metadata; versionId is bumped under the lock below
     patient.meta = {
-        "versionId": str(current_version + 1),
+        "versionId": "1",
         "lastUpdated": datetime.utcnow().isoformat() + "Z"
     }
     
     # Store in database
-    patients_db[patient_id] = patient.dict(exclude_none=True)
+    payload = patient.model_dump(exclude_none=True, mode="json")
+    with _db_lock:
+        existing = patients_db.get(patient_id)
+        if existing:
+            current_version = int(existing.get("meta", {}).get("versionId", "0"))
+            payload["meta"]["versionId"] = str(current_version + 1)
+            unindex_patient(patient_id, existing)
+        blob = orjson.dumps(payload)
+        patients_db[patient_id] = payload
+        patients_bytes[patient_id] = blob
+        index_patient(patient_id, payload)
     
-    return patients_db[patient_id]
+    return Response(content=blob, media_type="application/fhir+json")
 
 @app.delete("/Patient/{patient_id}")
 async def delete_patient(patient_id: str):
     """Delete a patient"""
-    if patient_id not in patients_db:
+    with _db_lock:
+        existing = patients_db.pop(patient_id, None)
+        if existing is not None:
+            del patients_bytes[patient_id]
+            unindex_patient(patient_id, existing)
+    
+    if existing is None:
         raise HTTPException(
             status_code=404,
             detail=create_operation_outcome("error", "not-found", f"Patient/{patient_id} not found")
         )
     
-    del patients_db[patient_id]
-    
-    return JSONResponse(status_code=204, content=None)
+    return Response(status_code=204)
 
 @app.get("/Patient")
 async def search_patients(
-    name: Optional[str] = None,
+    name: Optional[List[str]] = Query(None),
     family: Optional[str] = None, 
     given: Optional[str] = None,
     birthdate: Optional[str] = None,
     gender: Optional[str] = None,
-    _count: Optional[int] = 20,
-    _offset: Optional[int] = 0
+    _count: int = Query(20, ge=0),
+    _offset: int = Query(0, ge=0)
 ):
     """Search for patients"""
-    results = []
+    # Each parameter narrows to a set of IDs; parameters are ANDed. Filtered results
+    # are ordered by ID; unfiltered ones page straight over the store in creation order
+    matches: List[Set[str]] = []
     
-    for patient_data in patients_db.values():
-        match = True
+    with _db_lock:
+        # Repeated name parameters are ANDed, so one pass checks every term per patient
+        if name:
+            needles = [n.lower().encode() for n in name]
+            matches.append({
+                pid for pid, haystack in _name_haystack.items()
+                if all(needle in haystack for needle in needles)
+            })
         
-        # Simple string matching for name fields
-        if name and patient_data.get("name"):
-            name_match = any(
-                name.lower() in (n.get("family", "") + " " + " ".join(n.get("given", []))).lower()
-                for n in patient_data["name"]
-            )
-            if not name_match:
-                match = False
+        if family:
+            matches.append(match_index_substring(_idx_family, family))
         
-        if family and patient_data.get("name"):
-            family_match = any(
-                family.lower() in n.get("family", "").lower()
-                for n in patient_data["name"]
-            )
-            if not family_match:
-                match = False
+        if given:
+            matches.append(match_index_substring(_idx_given, given))
         
-        if given and patient_data.get("name"):
-            given_match = any(
-                any(given.lower() in g.lower() for g in n.get("given", []))
-                for n in patient_data["name"]
-            )
-            if not given_match:
-                match = False
+        if birthdate:
+            matches.append(_idx_birthdate.get(birthdate, set()))
         
-        if birthdate and patient_data.get("birthDate") != birthdate:
-            match = False
-            
-        if gender and patient_data.get("gender") != gender:
-            match = False
+        if gender:
+            matches.append(_idx_gender.get(gender.lower(), set()))
         
-        if match:
-            results.append(patient_data)
-    
-    # Apply pagination
-    total = len(results)
-    paginated_results = results[_offset:_offset + _count]
-    
-    # Create Bundle
-    bundle = {
-        "resourceType": "Bundle",
-        "type": "searchset",
-        "total": total,
-        "entry": [
-            {
-                "resource": result,
-                "search": {"mode": "match"}
-            }
-            for result in paginated_results
-        ]
-    }
+        if matches:
+            matches.sort(key=len)
+            ids = sorted(set.intersection(*matches))
+        else:
+            ids = patients_db
+        
+        # Apply pagination; only the page's resources are looked up
+        page = [patients_bytes[pid] for pid in itertools.islice(ids, _offset, _offset + _count)]
     
-    return bundle
+    return stream_searchset(len(ids), page)
 
 # Observation endpoints
 @app.post("/Observation", dependencies=[Depends(validate_fhir_content_type)])
-async def create_observation(observation_data: Dict[str, Any]):
+def create_observation(observation: Observation):
     """Create a new observation"""
-    observation = validate_fhir_resource(observation_data, Observation)
-    
     if not observation.id:
         observation.id = generate_id()
     
@@ -290,24 +422,33 @@ async def create_observation(observation_data: Dict[str, Any]):
         "lastUpdated": datetime.utcnow().isoformat() + "Z"
     }
     
-    observations_db[observation.id] = observation.dict(exclude_none=True)
+    payload = observation.model_dump(exclude_none=True, mode="json")
+    blob = orjson.dumps(payload)
+    with _db_lock:
+        if observation.id in observations_db:
+            unindex_observation(observation.id, observations_db[observation.id])
+        observations_db[observation.id] = payload
+        observations_bytes[observation.id] = blob
+        index_observation(observation.id, payload)
     
-    return JSONResponse(
+    return Response(
         status_code=201,
-        content=observations_db[observation.id],
+        content=blob,
+        media_type="application/fhir+json",
         headers={"Location": f"/Observation/{observation.id}"}
     )
 
 @app.get("/Observation/{observation_id}")
 async def get_observation(observation_id: str):
     """Read an observation by ID"""
-    if observation_id not in observations_db:
+    blob = observations_bytes.get(observation_id)
+    if blob is None:
         raise HTTPException(
             status_code=404,
             detail=create_operation_outcome("error", "not-found", f"Observation/{observation_id} not found")
         )
     
-    return observations_db[observation_id]
+    return Response(content=blob, media_type="application/fhir+json")
 
 @app.get("/Observation")
 async def search_observations(
@@ -315,60 +456,58 @@ async def search_observations(
     patient: Optional[str] = None,
     code: Optional[str] = None,
     date: Optional[str] = None,
-    _count: Optional[int] = 20
+    _count: int = Query(20, ge=0)
 ):
     """Search for observations"""
-    results = []
+    # Each parameter narrows to a set of IDs; parameters are ANDed. Filtered results
+    # are ordered by ID; unfiltered ones page straight over the store in creation order
+    matches: List[Set[str]] = []
     
-    for obs_data in observations_db.values():
-        match = True
-        
+    with _db_lock:
         # Subject/patient reference matching
-        if subject and obs_data.get("subject", {}).get("reference") != subject:
-            match = False
+        if subject:
+            matches.append(_idx_obs_subject.get(subject, set()))
         
-        if patient and obs_data.get("subject", {}).get("reference") != f"Patient/{patient}":
-            match = False
+        if patient:
+            matches.append(_idx_obs_subject.get(f"Patient/{patient}", set()))
         
-        # Simple code matching
-        if code and obs_data.get("code"):
-            code_match = any(
-                code in coding.get("code", "")
-                for coding in obs_data["code"].get("coding", [])
-            )
-            if not code_match:
-                match = False
+        # Token matching on code or system|code
+        if code:
+            matches.append(_idx_obs_code.get(code.lower(), set()))
         
-        # Date matching (simplified)
+        # Date prefix matching (YYYY, YYYY-MM, YYYY-MM-DD)
         if date:
-            obs_date = obs_data.get("effectiveDateTime", "")
-            if not obs_date.startswith(date):
-                match = False
+            matches.append(match_date_prefix(date))
         
-        if match:
-            results.append(obs_data)
-    
-    bundle = {
-        "resourceType": "Bundle",
-        "type": "searchset", 
-        "total": len(results),
-        "entry": [
-            {
-                "resource": result,
-                "search": {"mode": "match"}
-            }
-            for result in results[:_count]
-        ]
-    }
+        if matches:
+            matches.sort(key=len)
+            ids = sorted(set.intersection(*matches))
+        else:
+            ids = observations_db
+        
+        page = [observations_bytes[oid] for oid in itertools.islice(ids, _count)]
     
-    return bundle
+    return stream_searchset(len(ids), page)
 
 # Health check
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
+    return Response(
+        content=orjson.dumps({"status": "healthy", "timestamp": datetime.utcnow().isoformat()}),
+        media_type="application/json"
+    )
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # "auto" picks uvloop + httptools when installed (uvicorn[standard] ships uvloop
+    # only off Windows/PyPy) and falls back to asyncio + h11. Storage is in-process,
+    # so keep a single worker and scale out behind a reverse proxy instead.
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=port,
+        loop="auto",
+        http="auto",
+        log_level="warning"
+    )
@@ -4,20 +4,95 @@ FHIR Package Manager - Download, cache, and manage FHIR packages locally
 """
 
 import os
-import json
-import requests
+import orjson
+import httpx
 import tarfile
 import zipfile
+import tempfile
+import functools
+import re
 from pathlib import Path
 from typing import Dict, List, Optional, Any
 import argparse
 import sys
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _summarize_resource_file(file_path: Path) -> Any:
+    """Parse a resource file and return only its index fields, keeping what crosses the
+    process boundary small; returns the error instead of raising so pool.map keeps going"""
+    try:
+        resource = orjson.loads(file_path.read_bytes())
+    except (orjson.JSONDecodeError, IOError) as e:
+        return e
+    if not isinstance(resource, dict):
+        return ValueError("top-level JSON value is not an object")
+    return {
+        "resourceType": resource.get("resourceType", "unknown"),
+        "id": resource.get("id"),
+        "url": resource.get("url"),
+        "name": resource.get("name"),
+        "title": resource.get("title"),
+        "version": resource.get("version")
+    }
+
+
+@functools.lru_cache(maxsize=256)
+def _read_manifest(manifest_path: Path) -> Optional[bytes]:
+    """Read a package.json once; the raw bytes are cached so callers never share a dict"""
+    if not manifest_path.exists():
+        return None
+    return manifest_path.read_bytes()
+
+
+def _safe_tar_members(tar: tarfile.TarFile, destination: Path):
+    """Yield regular files and directories that stay inside destination"""
+    root = Path(destination).resolve()
+    for member in tar.getmembers():
+        target = (root / member.name).resolve()
+        if target != root and root not in target.parents:
+            raise ValueError(f"Refusing to extract {member.name!r} outside {root}")
+        if not (member.isfile() or member.isdir()):
+            raise ValueError(f"Refusing to extract special member {member.name!r}")
+        yield member
+
 
 class FHIRPackageManager:
+    # Cached resource index, written alongside each installed package; not *.json so
+    # get_resource_files never picks it up
+    INDEX_CACHE_FILE = "_index.cache"
+    # Packages with fewer resource files than this are indexed in-process
+    PARALLEL_INDEX_MIN_FILES = 1000
+    
     def __init__(self, cache_dir: str = None):
         self.cache_dir = Path(cache_dir or Path.home() / ".fhir" / "packages")
         self.cache_dir.mkdir(parents=True, exist_ok=True)
         self.registry_url = "https://packages.fhir.org"
+        self._client: Optional[httpx.Client] = None
+    
+    @property
+    def client(self) -> httpx.Client:
+        """Pooled HTTP/2 client, created on first network use so offline commands never need it"""
+        if self._client is None:
+            self._client = httpx.Client(
+                http2=True,
+                timeout=30,
+                follow_redirects=True,
+                limits=httpx.Limits(max_keepalive_connections=8)
+            )
+        return self._client
+    
+    def close(self):
+        """Close the HTTP client, if one was opened"""
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
     
     def install_package(self, package_id: str, version: str = "latest") -> Path:
         """Download and install a FHIR package"""
@@ -41,6 +116,14 @@ class FHIRPackageManager:
         
         package_dir.mkdir(parents=True, exist_ok=True)
         self._download_and_extract(download_url, package_dir)
+        _read_manifest.cache_clear()
+        
+        # Index once at install time so searches can load it from disk; best-effort,
+        # since the package is already usable and search rebuilds a missing index
+        try:
+            self.build_resource_index(package_id, version, rebuild=True)
+        except Exception as e:
+            print(f"Warning: could not index {package_id}@{version}: {e}")
         
         print(f"Package installed to {package_dir}")
         return package_dir
@@ -52,28 +135,41 @@ class FHIRPackageManager:
             if version != "latest":
                 url += f"/{version}"
             
-            response = requests.get(url)
+            response = self.client.get(url)
             response.raise_for_status()
             return response.json()
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             print(f"Error fetching metadata: {e}")
             return None
     
     def _download_and_extract(self, url: str, destination: Path):
         """Download and extract package archive"""
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        
-        # Determine archive type and extract
-        if url.endswith('.tgz') or url.endswith('.tar.gz'):
-            with tarfile.open(fileobj=response.raw, mode='r:gz') as tar:
-                tar.extractall(destination)
-        elif url.endswith('.zip'):
-            import io
-            with zipfile.ZipFile(io.BytesIO(response.content)) as zip_file:
-                zip_file.extractall(destination)
-        else:
+        is_tarball = url.endswith('.tgz') or url.endswith('.tar.gz')
+        if not is_tarball and not url.endswith('.zip'):
             raise ValueError(f"Unsupported archive format: {url}")
+        
+        # Spool the (content-decoded) body; it moves to disk past 32 MB instead of
+        # holding the whole archive in memory, and gives the extractors a seekable file
+        with tempfile.SpooledTemporaryFile(max_size=32 * 1024 * 1024) as tmp:
+            with self.client.stream("GET", url) as response:
+                response.raise_for_status()
+                for chunk in response.iter_bytes(chunk_size=64 * 1024):
+                    tmp.write(chunk)
+            tmp.seek(0)
+            
+            if is_tarball:
+                with tarfile.open(fileobj=tmp, mode='r:gz') as tar:
+                    # 'data' rejects absolute paths, links outside destination and
+                    # special files (CVE-2007-4559); interpreters without the PEP 706
+                    # backport (< 3.8.17 / 3.9.17 / 3.10.12 / 3.11.4) lack the filter
+                    # argument, so check members by hand there
+                    if hasattr(tarfile, "data_filter"):
+                        tar.extractall(destination, filter='data')
+                    else:
+                        tar.extractall(destination, members=_safe_tar_members(tar, destination))
+            else:
+                with zipfile.ZipFile(tmp) as zip_file:
+                    zip_file.extractall(destination)
     
     def list_installed(self) -> List[Dict[str, str]]:
         """List installed packages"""
@@ -95,13 +191,8 @@ class FHIRPackageManager:
     def load_package_manifest(self, package_id: str, version: str = "latest") -> Optional[Dict]:
         """Load package.json manifest from installed package"""
         package_dir = self.cache_dir / package_id / version
-        manifest_path = package_dir / "package.json"
-        
-        if not manifest_path.exists():
-            return None
-            
-        with open(manifest_path, 'r') as f:
-            return json.load(f)
+        manifest = _read_manifest(package_dir / "package.json")
+        return orjson.loads(manifest) if manifest is not None else None
     
     def get_resource_files(self, package_id: str, version: str = "latest", 
                           resource_type: str = None) -> List[Path]:
@@ -111,26 +202,41 @@ class FHIRPackageManager:
         if not package_dir.exists():
             return []
         
-        # Look for resources in common locations
-        search_dirs = [
-            package_dir / "package",
-            package_dir,
-            package_dir / "input"
-        ]
+        # package/ and input/ live under package_dir, so a single walk covers them
+        pattern = "*.json"
+        if resource_type:
+            pattern = f"*{resource_type}*.json"
+            # Matches the resourceType field without parsing; files whose head has no
+            # resourceType at all are kept since the field may come later
+            type_field = re.compile(rb'"resourceType"\s*:\s*"([^"]*)"')
         
         resource_files = []
-        for search_dir in search_dirs:
-            if search_dir.exists():
-                pattern = "*.json"
-                if resource_type:
-                    pattern = f"*{resource_type}*.json"
-                
-                resource_files.extend(search_dir.rglob(pattern))
+        seen = set()
+        for file_path in package_dir.rglob(pattern):
+            resolved = file_path.resolve()
+            if resolved in seen:
+                continue
+            seen.add(resolved)
+            
+            if resource_type:
+                with open(file_path, 'rb') as f:
+                    found = type_field.search(f.read(256))
+                if found and found.group(1).decode() != resource_type:
+                    continue
+            
+            resource_files.append(file_path)
         
         return resource_files
     
-    def build_resource_index(self, package_id: str, version: str = "latest") -> Dict[str, List[Dict]]:
-        """Build searchable index of FHIR resources in package"""
+    def build_resource_index(self, package_id: str, version: str = "latest",
+                             rebuild: bool = False) -> Dict[str, List[Dict]]:
+        """Build searchable index of FHIR resources in package, reusing the on-disk cache"""
+        package_dir = self.cache_dir / package_id / version
+        index_path = package_dir / self.INDEX_CACHE_FILE
+        
+        if not rebuild and index_path.exists():
+            return orjson.loads(index_path.read_bytes())
+        
         index = {
             "StructureDefinition": [],
             "ValueSet": [],
@@ -143,33 +249,34 @@ class FHIRPackageManager:
         
         resource_files = self.get_resource_files(package_id, version)
         
-        for file_path in resource_files:
-            try:
-                with open(file_path, 'r') as f:
-                    resource = json.load(f)
-                
-                resource_type = resource.get("resourceType", "unknown")
-                
-                if resource_type in index:
-                    index[resource_type].append({
-                        "id": resource.get("id"),
-                        "url": resource.get("url"),
-                        "name": resource.get("name"),
-                        "title": resource.get("title"),
-                        "version": resource.get("version"),
-                        "file_path": str(file_path)
-                    })
-                else:
-                    # Treat as example
-                    index["examples"].append({
-                        "resourceType": resource_type,
-                        "id": resource.get("id"),
-                        "file_path": str(file_path)
-                    })
-            
-            except (json.JSONDecodeError, IOError) as e:
-                print(f"Error processing {file_path}: {e}")
+        # Reading and parsing is independent per file, so spread large packages across
+        # cores; below the threshold process startup costs more than it saves
+        if len(resource_files) >= self.PARALLEL_INDEX_MIN_FILES:
+            with ProcessPoolExecutor() as pool:
+                summaries = list(pool.map(_summarize_resource_file, resource_files, chunksize=64))
+        else:
+            summaries = [_summarize_resource_file(file_path) for file_path in resource_files]
+        
+        for file_path, summary in zip(resource_files, summaries):
+            if isinstance(summary, Exception):
+                print(f"Error processing {file_path}: {summary}")
                 continue
+            
+            resource_type = summary.pop("resourceType")
+            summary["file_path"] = str(file_path)
+            
+            if resource_type in index:
+                index[resource_type].append(summary)
+            else:
+                # Treat as example
+                index["examples"].append({
+                    "resourceType": resource_type,
+                    "id": summary["id"],
+                    "file_path": summary["file_path"]
+                })
+        
+        if package_dir.exists():
+            index_path.write_bytes(orjson.dumps(index))
         
         return index
     
@@ -219,6 +326,7 @@ def main():
     index_parser = subparsers.add_parser("index", help="Build resource index for package")
     index_parser.add_argument("package_id", help="Package ID")
     index_parser.add_argument("--version", default="latest", help="Package version")
+    index_parser.add_argument("--rebuild", action="store_true", help="Ignore the cached index")
     
     args = parser.parse_args()
     
@@ -226,43 +334,42 @@ def main():
         parser.print_help()
         return
     
-    manager = FHIRPackageManager(args.cache_dir)
-    
-    if args.command == "install":
-        try:
-            manager.install_package(args.package_id, args.version)
-        except Exception as e:
-            print(f"Error installing package: {e}", file=sys.stderr)
-            sys.exit(1)
-    
-    elif args.command == "list":
-        packages = manager.list_installed()
-        if packages:
-            print("Installed packages:")
-            for pkg in packages:
-                print(f"  {pkg['id']}@{pkg['version']} -> {pkg['path']}")
-        else:
-            print("No packages installed")
-    
-    elif args.command == "search":
-        results = manager.search_resources(args.package_id, args.version, 
-                                         args.query, args.type)
-        if results:
-            print(f"Found {len(results)} resources:")
-            for result in results:
-                name = result.get("name") or result.get("id", "unknown")
-                print(f"  {result['resourceType']}: {name}")
-                if result.get("url"):
-                    print(f"    URL: {result['url']}")
-        else:
-            print("No resources found")
-    
-    elif args.command == "index":
-        index = manager.build_resource_index(args.package_id, args.version)
-        print(f"Resource index for {args.package_id}@{args.version}:")
-        for res_type, resources in index.items():
-            if resources:
-                print(f"  {res_type}: {len(resources)} resources")
+    with FHIRPackageManager(args.cache_dir) as manager:
+        if args.command == "install":
+            try:
+                manager.install_package(args.package_id, args.version)
+            except Exception as e:
+                print(f"Error installing package: {e}", file=sys.stderr)
+                sys.exit(1)
+        
+        elif args.command == "list":
+            packages = manager.list_installed()
+            if packages:
+                print("Installed packages:")
+                for pkg in packages:
+                    print(f"  {pkg['id']}@{pkg['version']} -> {pkg['path']}")
+            else:
+                print("No packages installed")
+        
+        elif args.command == "search":
+            results = manager.search_resources(args.package_id, args.version, 
+                                             args.query, args.type)
+            if results:
+                print(f"Found {len(results)} resources:")
+                for result in results:
+                    name = result.get("name") or result.get("id", "unknown")
+                    print(f"  {result['resourceType']}: {name}")
+                    if result.get("url"):
+                        print(f"    URL: {result['url']}")
+            else:
+                print("No resources found")
+        
+        elif args.command == "index":
+            index = manager.build_resource_index(args.package_id, args.version, args.rebuild)
+            print(f"Resource index for {args.package_id}@{args.version}:")
+            for res_type, resources in index.items():
+                if resources:
+                    print(f"  {res_type}: {len(resources)} resources")
 
 
 if __name__ == "__main__":